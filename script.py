@@ -13,7 +13,7 @@ Syntax:
 
     sdc-transfer-instance --source-instance <source-instance-uuid> \
       --dest-project <destination-project-name | destination-project-uuid> \
-      --dest-instance <destination-instance-name> [--move]
+      --dest-instance <destination-instance-name> [--move] [--verify]
 
 --source-instance <source-instance-uuid>
     The uuid of the instance to be transferred.
@@ -34,6 +34,43 @@ Syntax:
     Equivalent to `mv` command.
     Optional parameter.
 
+--verify
+    Verify the transferred volumes against the source volumes once they are
+    attached to the destination instance. The size, type, bootable flag and
+    device mapping are compared. The contents of each volume created from a
+    snapshot are compared with the snapshot, before the volume is attached,
+    using fingerprints built by hashing a sample of fixed-size blocks. Clean
+    up is skipped if the verification fails.
+    Optional parameter.
+
+--verify-sample-rate <fraction>
+    Fraction of the blocks of each volume to hash while verifying.
+    Optional parameter (default: 0.01).
+
+--verify-block-size <bytes>
+    Size of the blocks hashed while verifying.
+    Optional parameter (default: 4194304).
+
+--verify-workers <count>
+    Number of processes hashing blocks while verifying.
+    Optional parameter (default: number of CPUs).
+
+--verify-path <template>
+    Template of the path of the block device of a volume, with `%s` standing
+    in for the volume uuid. The script must be able to read the volumes at
+    this path, e.g. by running it on the cinder-volume host.
+    Optional parameter (default: /dev/cinder-volumes/volume-%s).
+
+--verify-snapshot-path <template>
+    Template of the path of the block device of a volume snapshot, with `%s`
+    standing in for the snapshot uuid.
+    Optional parameter (default: /dev/cinder-volumes/_snapshot-%s).
+
+--verify-attach-timeout <seconds>
+    Seconds to wait for the volumes to be attached to the destination
+    instance before verifying them.
+    Optional parameter (default: 300).
+
 Note:
     Please ensure that you have sourced the credentials of an admin user who is
     in both the projects before running the script.
@@ -48,6 +85,10 @@ import json
 import time
 import argparse
 import re
+import math
+import random
+import hashlib
+import multiprocessing
 from oslo_utils import uuidutils
 from subprocess import Popen, PIPE
 from distutils.spawn import find_executable
@@ -56,6 +97,9 @@ from distutils.spawn import find_executable
 STDOUT = PIPE
 STDERR = PIPE
 
+VOLUME_PATH_TEMPLATE = '/dev/cinder-volumes/volume-%s'
+SNAPSHOT_PATH_TEMPLATE = '/dev/cinder-volumes/_snapshot-%s'
+
 
 def parse_list_output(output):
     """Parse the output of list commands (like `openstack project list`)."""
@@ -390,6 +434,229 @@ def attach_volumes(instance_id, volumes):
                                              stderr=STDERR).communicate()[0])
 
 
+def wait_for_volumes_in_use(volumes, wait_for_available=300):
+    """
+    Wait for the volumes to be attached. Returns False if the wait timed out.
+    """
+    if type(volumes) is not list:
+        volumes = [volumes]
+    wait = 0
+    again = False
+    while wait < wait_for_available:
+        again = False
+        for volume in volumes:
+            command = 'cinder show %s' % volume['id']
+            status = parse_output(Popen(command.split(), stdout=STDOUT,
+                                        stderr=STDERR).communicate()[0]
+                                  )['status']
+            if status != 'in-use':
+                again = True
+                break
+        if again:
+            time.sleep(5)
+            wait += 5
+            continue
+        else:
+            break
+    return not again
+
+
+def sample_block_offsets(volume, sample_rate, block_size):
+    """
+    Return the offsets of the blocks of the volume to be hashed.
+
+    The blocks are picked at random, seeded by the volume id, so that the same
+    offsets are sampled every time for a given source volume.
+    """
+    size = int(volume['size']) * 1024 ** 3
+    blocks = max(1, int(math.ceil(size / float(block_size))))
+    count = min(blocks, max(1, int(math.ceil(blocks * sample_rate))))
+    sample = random.Random(volume['id']).sample(xrange(blocks), count)
+    return sorted(block * block_size for block in sample)
+
+
+def _hash_block(task):
+    """
+    Return the sha256 digest of the block of the given size at the given
+    offset of a file of the given size, or None if the file could not be read
+    or is shorter than expected.
+    """
+    path, offset, block_size, size = task
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(block_size)
+    except (IOError, OSError):
+        return None
+    if len(data) != min(block_size, size - offset):
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_volume_fingerprints(volume_pairs, sample_rate, block_size, workers,
+                            source_path_template, dest_path_template):
+    """
+    Hash a sample of blocks of the source and destination volume of each pair
+    over a pool of processes.
+
+    Both volumes of a pair are expected to be of the size of the source.
+    Returns a list of (source fingerprint, destination fingerprint, number of
+    blocks sampled) in the order of volume_pairs. A fingerprint is None if any
+    of the sampled blocks of the volume could not be read.
+    """
+    tasks = []
+    counts = []
+    for source, dest in volume_pairs:
+        size = int(source['size']) * 1024 ** 3
+        offsets = sample_block_offsets(source, sample_rate, block_size)
+        for path in (source_path_template % source['id'],
+                     dest_path_template % dest['id']):
+            tasks.extend((path, offset, block_size, size)
+                         for offset in offsets)
+        counts.append(len(offsets))
+    pool = multiprocessing.Pool(workers)
+    try:
+        digests = pool.map(_hash_block, tasks,
+                           chunksize=max(1, len(tasks) / (workers * 4)))
+    finally:
+        pool.close()
+        pool.join()
+    fingerprints = []
+    start = 0
+    for count in counts:
+        fingerprint = []
+        for volume_digests in (digests[start:start + count],
+                               digests[start + count:start + 2 * count]):
+            if None in volume_digests:
+                fingerprint.append(None)
+            else:
+                fingerprint.append(hashlib.sha256(
+                    ''.join(volume_digests)).hexdigest())
+        fingerprints.append((fingerprint[0], fingerprint[1], count))
+        start += 2 * count
+    return fingerprints
+
+
+def verify_volume_contents(snapshots, volumes, sample_rate=0.01,
+                           block_size=4 * 1024 ** 2, workers=None,
+                           snapshot_path_template=SNAPSHOT_PATH_TEMPLATE,
+                           volume_path_template=VOLUME_PATH_TEMPLATE):
+    """
+    Compare the contents of the volumes created from snapshots with the
+    snapshots they were created from.
+
+    This has to be done before the volumes are attached to an instance, as
+    the snapshots are the only copy of the source that does not change while
+    the source instance is running. Volumes not created from any of the
+    snapshots are skipped.
+
+    Returns a dictionary of (passed, detail) by the id of the volume.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if type(snapshots) is not list:
+        snapshots = [snapshots]
+    if type(volumes) is not list:
+        volumes = [volumes]
+    pairs = []
+    for volume in volumes:
+        snapshot = get(snapshots, 'id', volume.get('snapshot_id'))
+        if snapshot:
+            pairs.append((snapshot[0], volume))
+    results = {}
+    if not pairs:
+        return results
+    fingerprints = get_volume_fingerprints(pairs, sample_rate, block_size,
+                                           workers, snapshot_path_template,
+                                           volume_path_template)
+    for (snapshot, volume), fingerprint in zip(pairs, fingerprints):
+        snapshot_fp, volume_fp, count = fingerprint
+        if snapshot_fp is None:
+            results[volume['id']] = (False, 'unreadable or short at %s' %
+                                     (snapshot_path_template % snapshot['id']))
+        elif volume_fp is None:
+            results[volume['id']] = (False, 'unreadable or short at %s' %
+                                     (volume_path_template % volume['id']))
+        else:
+            results[volume['id']] = (snapshot_fp == volume_fp,
+                                     '%d blocks sampled against snapshot %s' %
+                                     (count, snapshot['id']))
+    return results
+
+
+def verify_volumes(source_volumes, dest_volumes, dest_instance_id,
+                   content_results, wait_for_attached=300):
+    """
+    Compare the volumes attached to the destination instance with the source
+    volumes they were transferred from.
+
+    The volumes are paired by the device the destination volume was meant to
+    be attached at, which is then compared with the device it was actually
+    attached at. The size, type and bootable flag of each pair are compared,
+    and the content check is taken from content_results (see
+    verify_volume_contents). Volumes transferred without a copy (same id on
+    either side) need no content check.
+
+    Returns a list of dictionaries, one per source volume, with the results
+    of each check and whether the pair passed all of them.
+    """
+    attached = wait_for_volumes_in_use(dest_volumes, wait_for_attached)
+    report = []
+    for source in source_volumes:
+        dest = get(dest_volumes, 'device', source['device'])
+        result = {'device': source['device'], 'source_id': source['id'],
+                  'dest_id': dest[0]['id'] if dest else None, 'checks': []}
+        report.append(result)
+        if not dest:
+            result['checks'].append(('device', False, 'not transferred'))
+            result['passed'] = False
+            continue
+        command = 'cinder show %s' % dest[0]['id']
+        dest = parse_output(Popen(command.split(), stdout=STDOUT,
+                                  stderr=STDERR).communicate()[0])
+        att = dest['attachments'].replace("'", "\"").replace(
+            "u\"", "\"").replace(" None,", " \"None\",")
+        attachments = get(json.loads(att), 'server_id', dest_instance_id)
+        if not attachments:
+            if attached:
+                detail = 'not attached'
+            else:
+                detail = 'not attached after waiting %d seconds' % \
+                         wait_for_attached
+            result['checks'].append(('device', False, detail))
+        else:
+            device = attachments[0]['device']
+            result['checks'].append(('device', device == source['device'],
+                                     '%s -> %s' % (source['device'], device)))
+        for key in ('size', 'volume_type', 'bootable'):
+            result['checks'].append(
+                (key, source[key] == dest[key],
+                 '%s -> %s' % (source[key], dest[key])))
+        if source['id'] == dest['id']:
+            result['checks'].append(('content', True, 'same volume'))
+        elif dest['id'] in content_results:
+            passed, detail = content_results[dest['id']]
+            result['checks'].append(('content', passed, detail))
+        else:
+            result['checks'].append(('content', False, 'not checked'))
+        result['passed'] = all(check[1] for check in result['checks'])
+    return report
+
+
+def print_verification_report(report):
+    """Print the results of the verification of the transferred volumes."""
+    for result in report:
+        print '%s: %s -> %s' % (result['device'], result['source_id'],
+                                result['dest_id'])
+        for name, passed, detail in result['checks']:
+            print '\t %-12s %s (%s)' % (name, 'PASS' if passed else 'FAIL',
+                                        detail)
+    if all(result['passed'] for result in report):
+        print 'Verification PASSED.'
+    else:
+        print 'Verification FAILED.'
+
+
 def boot_from_volume(dest_project_id, bootable_volume_id, flavor, name,
                      objects_created):
     """
@@ -535,6 +802,40 @@ def main(argv):
                         ' instance will belong.', metavar='project_name',
                         dest='dest_project_name')
     parser.add_argument('--move', action='store_true')
+    parser.add_argument('--verify', action='store_true',
+                        help='Verify the transferred volumes against the ' +
+                        'source volumes.')
+    parser.add_argument('--verify-sample-rate', type=float, default=0.01,
+                        help='Fraction of the blocks of each volume to ' +
+                        'hash while verifying (default: 0.01).',
+                        metavar='fraction', dest='verify_sample_rate')
+    parser.add_argument('--verify-block-size', type=int,
+                        default=4 * 1024 ** 2,
+                        help='Size in bytes of the blocks hashed while ' +
+                        'verifying (default: 4194304).', metavar='bytes',
+                        dest='verify_block_size')
+    parser.add_argument('--verify-workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of processes hashing blocks while ' +
+                        'verifying (default: number of CPUs).',
+                        metavar='count', dest='verify_workers')
+    parser.add_argument('--verify-path', type=str,
+                        default=VOLUME_PATH_TEMPLATE,
+                        help='Path of the block device of a volume, with ' +
+                        '%%s for the volume uuid (default: ' +
+                        VOLUME_PATH_TEMPLATE.replace('%', '%%') + ').',
+                        metavar='template', dest='verify_path')
+    parser.add_argument('--verify-snapshot-path', type=str,
+                        default=SNAPSHOT_PATH_TEMPLATE,
+                        help='Path of the block device of a volume ' +
+                        'snapshot, with %%s for the snapshot uuid ' +
+                        '(default: ' +
+                        SNAPSHOT_PATH_TEMPLATE.replace('%', '%%') + ').',
+                        metavar='template', dest='verify_snapshot_path')
+    parser.add_argument('--verify-attach-timeout', type=int, default=300,
+                        help='Seconds to wait for the volumes to be ' +
+                        'attached before verifying (default: 300).',
+                        metavar='seconds', dest='verify_attach_timeout')
 
     args = parser.parse_args()
 
@@ -544,6 +845,25 @@ def main(argv):
         print 'Source instance UUID is not a proper UUID. Please correct.'
         sys.exit(-1)
 
+    if args.verify:
+        if not 0 < args.verify_sample_rate <= 1:
+            print 'Verification sample rate must be in the range (0, 1].'
+            sys.exit(-1)
+        if args.verify_block_size <= 0 or args.verify_workers <= 0 or \
+                args.verify_attach_timeout <= 0:
+            print 'Verification block size, workers and attach timeout ' + \
+                'must be positive.'
+            sys.exit(-1)
+        for template in (args.verify_path, args.verify_snapshot_path):
+            try:
+                valid = template % 'x' != template % 'y'
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                print "Verification path '%s' must contain a single %%s " \
+                    "for the uuid (use %%%% for a literal '%%')." % template
+                sys.exit(-1)
+
     dest_project_name = args.dest_project_name
     if args.move:
         move = True
@@ -597,6 +917,9 @@ def main(argv):
     attached_volumes = json.loads(
         source_instance['os-extended-volumes:volumes_attached'])
     attached_volumes_list = get_volume_info(attached_volumes)
+    # Keep the source volumes around for verification, as the list is
+    # modified while moving.
+    source_volumes_list = list(attached_volumes_list)
 
     objects_created = []
 
@@ -652,6 +975,36 @@ def main(argv):
         delete_instances(source_instance)
         volume_from_snapshot_list = attached_volumes_list
 
+    dest_volumes_list = list(volume_from_snapshot_list)
+
+    content_results = {}
+    if args.verify and not (move and ephemeral):
+        # The new volumes are compared with the snapshots they were created
+        # from before anything writes to them. This also covers the root
+        # volume when moving, as the source root volume may be gone by now.
+        print "Verifying contents of volumes created from snapshots..."
+        content_results = verify_volume_contents(
+            snapshot_info_list, volume_from_snapshot_list,
+            sample_rate=args.verify_sample_rate,
+            block_size=args.verify_block_size,
+            workers=args.verify_workers,
+            snapshot_path_template=args.verify_snapshot_path,
+            volume_path_template=args.verify_path)
+        if not all(passed for passed, detail in content_results.values()):
+            print_verification_report(
+                [{'device': volume['device'],
+                  'source_id': volume['snapshot_id'],
+                  'dest_id': volume['id'],
+                  'checks': [('content',) + content_results[volume['id']]],
+                  'passed': content_results[volume['id']][0]}
+                 for volume in volume_from_snapshot_list
+                 if volume['id'] in content_results])
+            print 'Error verifying volumes created from snapshots! ' + \
+                'Skipping transfer and clean up.'
+            print 'The following entities were created in the process:'
+            print_objects_created(objects_created)
+            sys.exit(-1)
+
     # Create transfer requests
     print "Initializing transfer requests..."
     transfer_request_list = create_volume_transfer_request(
@@ -687,6 +1040,18 @@ def main(argv):
 
     attach_volumes(dest_instance['id'], volume_from_snapshot_list)
 
+    if args.verify:
+        print "Verifying transferred volumes..."
+        report = verify_volumes(source_volumes_list, dest_volumes_list,
+                                dest_instance['id'], content_results,
+                                args.verify_attach_timeout)
+        print_verification_report(report)
+        if not all(result['passed'] for result in report):
+            print 'Error verifying transferred volumes! Skipping clean up.'
+            print 'The following entities were created in the process:'
+            print_objects_created(objects_created)
+            sys.exit(-1)
+
     if not ephemeral or (ephemeral and not move):
         # Delete volume snapshots
         print "Cleaning up snapshots..."
@@ -0,0 +1,247 @@
+"""Tests for the sampling and hashing used to verify transferred volumes."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import script
+
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+
+class SampleBlockOffsetsTest(unittest.TestCase):
+
+    def test_offsets_are_deterministic_per_volume(self):
+        volume = {'id': 'source', 'size': '10'}
+        self.assertEqual(script.sample_block_offsets(volume, 0.01, MB),
+                         script.sample_block_offsets(volume, 0.01, MB))
+        other = {'id': 'other', 'size': '10'}
+        self.assertNotEqual(script.sample_block_offsets(volume, 0.01, MB),
+                            script.sample_block_offsets(other, 0.01, MB))
+
+    def test_offsets_are_aligned_sorted_and_in_range(self):
+        volume = {'id': 'source', 'size': '2'}
+        offsets = script.sample_block_offsets(volume, 0.05, MB)
+        self.assertEqual(offsets, sorted(set(offsets)))
+        for offset in offsets:
+            self.assertEqual(offset % MB, 0)
+            self.assertTrue(0 <= offset < 2 * GB)
+
+    def test_count_is_bounded_by_sample_rate(self):
+        volume = {'id': 'source', 'size': '1'}
+        self.assertEqual(len(script.sample_block_offsets(volume, 0.01, MB)),
+                         11)
+        self.assertEqual(len(script.sample_block_offsets(volume, 1, MB)),
+                         1024)
+        self.assertEqual(len(script.sample_block_offsets(volume, 1e-9, MB)),
+                         1)
+
+
+class VolumeFingerprintsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.template = os.path.join(self.directory, '%s')
+        self.data = os.urandom(MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_volume(self, name, size=GB, data=None, offset=0):
+        """Create a sparse file with data at the given offset of it."""
+        with open(self.template % name, 'wb') as f:
+            f.seek(offset)
+            f.write(self.data if data is None else data)
+            f.truncate(size)
+        return {'id': name, 'size': '1'}
+
+    def fingerprints(self, pairs, sample_rate=0.125):
+        return script.get_volume_fingerprints(pairs, sample_rate, 64 * MB, 2,
+                                              self.template, self.template)
+
+    def test_matching_and_changed_volumes(self):
+        offset = script.sample_block_offsets({'id': 'source', 'size': '1'},
+                                             0.125, 64 * MB)[-1]
+        source = self.make_volume('source', offset=offset)
+        copy = self.make_volume('copy', offset=offset)
+        changed = self.make_volume('changed', data=self.data[:-1] + 'x',
+                                   offset=offset)
+        same, different = self.fingerprints([(source, copy),
+                                             (source, changed)])
+        self.assertEqual(same[0], same[1])
+        self.assertEqual(same[2], 2)
+        self.assertNotEqual(different[0], different[1])
+        self.assertEqual(same[0], different[0])
+
+    def test_digests_are_split_between_source_and_destination(self):
+        source = self.make_volume('source')
+        dest = self.make_volume('dest')
+        missing = {'id': 'missing', 'size': '1'}
+        result = self.fingerprints([(source, missing), (source, dest),
+                                    (missing, dest)])
+        self.assertNotEqual(result[0][0], None)
+        self.assertEqual(result[0][1], None)
+        self.assertEqual(result[0][0], result[1][0])
+        self.assertEqual(result[1][0], result[1][1])
+        self.assertEqual(result[2][0], None)
+        self.assertNotEqual(result[2][1], None)
+
+    def test_short_volume_is_not_readable(self):
+        source = self.make_volume('source')
+        short = self.make_volume('short', size=10, data='0123456789')
+        result = self.fingerprints([(source, short), (short, source)])
+        self.assertNotEqual(result[0][0], None)
+        self.assertEqual(result[0][1], None)
+        self.assertEqual(result[1][0], None)
+
+
+class HashBlockTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.write(handle, 'a' * 100)
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_last_partial_block_is_hashed(self):
+        self.assertNotEqual(script._hash_block((self.path, 64, 64, 100)),
+                            None)
+
+    def test_short_read_is_a_failure(self):
+        self.assertEqual(script._hash_block((self.path, 64, 64, 128)), None)
+        self.assertEqual(script._hash_block((self.path, 128, 64, 192)), None)
+
+    def test_unreadable_file_is_a_failure(self):
+        self.assertEqual(script._hash_block((self.path + '-missing', 0, 64,
+                                             64)), None)
+
+
+class FakePopen(object):
+    """Stand-in for Popen answering `cinder show` from a dict of volumes."""
+
+    volumes = {}
+
+    def __init__(self, command, stdout=None, stderr=None):
+        self.volume = self.volumes[command[-1]]
+
+    def communicate(self):
+        rows = ['| %s | %s |' % item for item in self.volume.items()]
+        border = '+----------+-------+'
+        return '\n'.join([border, '| Property | Value |', border] + rows +
+                         [border]), ''
+
+
+class VerifyVolumesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.popen = script.Popen
+        script.Popen = FakePopen
+
+    def tearDown(self):
+        script.Popen = self.popen
+
+    def volume(self, id, device, attached_device=None, status='in-use'):
+        """Return the volume as listed, and as shown by cinder afterwards."""
+        attachments = []
+        if attached_device:
+            attachments.append({'server_id': 'dest', 'device':
+                                attached_device})
+        FakePopen.volumes[id] = {'id': id, 'status': status, 'size': '1',
+                                 'volume_type': 'ssd', 'bootable': 'false',
+                                 'attachments': str(attachments)}
+        return {'id': id, 'device': device, 'size': '1',
+                'volume_type': 'ssd', 'bootable': 'false'}
+
+    def test_volumes_are_paired_by_intended_device(self):
+        sources = [self.volume('s1', '/dev/vda'),
+                   self.volume('s2', '/dev/vdb')]
+        dests = [self.volume('d2', '/dev/vdb', '/dev/vdc'),
+                 self.volume('d1', '/dev/vda', '/dev/vda')]
+        report = script.verify_volumes(sources, dests, 'dest',
+                                       {'d1': (True, 'ok'),
+                                        'd2': (True, 'ok')})
+        self.assertEqual([(r['source_id'], r['dest_id']) for r in report],
+                         [('s1', 'd1'), ('s2', 'd2')])
+        self.assertTrue(report[0]['passed'])
+        self.assertFalse(report[1]['passed'])
+        checks = dict((name, (passed, detail))
+                      for name, passed, detail in report[1]['checks'])
+        self.assertEqual(checks['device'], (False, '/dev/vdb -> /dev/vdc'))
+        self.assertEqual(checks['size'], (True, '1 -> 1'))
+        self.assertEqual(checks['content'], (True, 'ok'))
+
+    def test_missing_attachment_and_content(self):
+        sources = [self.volume('s1', '/dev/vdb'),
+                   self.volume('s2', '/dev/vdc'),
+                   self.volume('s3', '/dev/vdd')]
+        dests = [self.volume('d1', '/dev/vdb'),
+                 self.volume('d2', '/dev/vdc', '/dev/vdc')]
+        report = script.verify_volumes(sources, dests, 'dest', {})
+        self.assertEqual(report[0]['checks'][0],
+                         ('device', False, 'not attached'))
+        self.assertEqual(report[1]['checks'][-1],
+                         ('content', False, 'not checked'))
+        self.assertEqual(report[2]['checks'],
+                         [('device', False, 'not transferred')])
+        self.assertFalse(any(result['passed'] for result in report))
+
+    def test_moved_volume_needs_no_content_check(self):
+        source = self.volume('s1', '/dev/vdb', '/dev/vdb')
+        report = script.verify_volumes([source], [source], 'dest', {})
+        self.assertEqual(report[0]['checks'][-1],
+                         ('content', True, 'same volume'))
+        self.assertTrue(report[0]['passed'])
+
+    def test_attach_timeout_is_reported(self):
+        sleep = script.time.sleep
+        script.time.sleep = lambda seconds: None
+        try:
+            source = self.volume('s1', '/dev/vdb')
+            dest = self.volume('d1', '/dev/vdb', status='attaching')
+            report = script.verify_volumes([source], [dest], 'dest',
+                                           {'d1': (True, 'ok')}, 10)
+        finally:
+            script.time.sleep = sleep
+        self.assertEqual(report[0]['checks'][0],
+                         ('device', False,
+                          'not attached after waiting 10 seconds'))
+
+
+class PrintVerificationReportTest(unittest.TestCase):
+
+    def report(self, report):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            script.print_verification_report(report)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_passed_and_failed_reports(self):
+        passed = {'device': '/dev/vdb', 'source_id': 's1', 'dest_id': 'd1',
+                  'checks': [('device', True, '/dev/vdb -> /dev/vdb')],
+                  'passed': True}
+        failed = {'device': '/dev/vdc', 'source_id': 's2', 'dest_id': None,
+                  'checks': [('device', False, 'not transferred')],
+                  'passed': False}
+        output = self.report([passed])
+        self.assertTrue('/dev/vdb: s1 -> d1' in output)
+        self.assertTrue('PASS (/dev/vdb -> /dev/vdb)' in output)
+        self.assertTrue(output.endswith('Verification PASSED.\n'))
+        output = self.report([passed, failed])
+        self.assertTrue('FAIL (not transferred)' in output)
+        self.assertTrue(output.endswith('Verification FAILED.\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()